@@ -1,26 +1,63 @@
 import requests
 import pandas as pd
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
 from typing import Callable
 import configparser
 import logging
 import json
 import os
 import datetime as dt
+import functools
+import glob
+
+REQUEST_TIMEOUT = 10
+POOL_MAXSIZE = 32
+# images are already compressed, ask for them as-is so they stream unaltered
+IMAGE_HEADERS = {'Accept-Encoding': 'identity'}
+
+# Shared session so repeated requests to the same host reuse keep-alive
+# connections. Pool is sized for the concurrent headshot downloads.
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=4,
+                       pool_maxsize=POOL_MAXSIZE,
+                       max_retries=Retry(total=3, backoff_factor=0.3))
+_SESSION.mount('http://', _ADAPTER)
+_SESSION.mount('https://', _ADAPTER)
+
+
+# Parsers are cached on the raw config string, as ConfigParser itself is not
+# hashable. Tuples are cached so callers always receive a fresh list/dict.
+@functools.lru_cache(maxsize=256)
+def _parse_dict(value: str):
+
+    init_split = value.split(',')
+    split_pairs = [pair.split(': ') for pair in init_split]
+
+    return tuple((k.strip(), v.strip()) for k, v in split_pairs)
+
 
 def cfg_get_dict(config: configparser.ConfigParser,
                  section: str,
                  variable: str):
 
-    logging.debug('Parsing config value as a dict: {0}:{1}'.format(section,
-                                                                   variable))
+    logging.debug('Parsing config value as a dict: %s:%s', section, variable)
     value = config[section][variable]
-    init_split = value.split(',')
-    split_pairs = [pair.split(': ') for pair in init_split]
-    dict_value = {k.strip(): v.strip() for k,v in split_pairs}
+    dict_value = dict(_parse_dict(value))
 
     return dict_value
 
+
+@functools.lru_cache(maxsize=256)
+def _parse_list(value: str, cast: Callable):
+
+    return tuple(cast(v.strip()) for v in value.split(','))
+
+
 def cfg_get_list(config: configparser.ConfigParser,
                  section: str,
                  variable: str,
@@ -46,21 +83,92 @@ def cfg_get_list(config: configparser.ConfigParser,
     value_list: list
         List containing elements of config value.
     """
-    logging.debug('Parsing config value as a list: {0}:{1}'.format(section,
-                                                                   variable))
+    logging.debug('Parsing config value as a list: %s:%s', section, variable)
     value = config[section][variable]
-    value_list = value.split(',')
-    value_list = [cast(v.strip()) for v in value_list]
+    value_list = list(_parse_list(value, cast))
 
     return value_list
 
 
+_MISSING = object()
+
+
+def _resolve(record: dict, path: tuple, levels: int):
+
+    value = record
+    for key in path:
+        try:
+            value = value[key]
+        except (KeyError, TypeError):
+            return _MISSING
+
+    # dicts within max_level are expanded into sub-columns by json_normalize,
+    # e.g. MNIS nulls {"@xsi:nil": "true"}, so the plain column is empty
+    if isinstance(value, dict) and len(path) <= levels:
+        return _MISSING
+
+    return value
+
+
+def flatten_records(records: list,
+                    columns: list,
+                    sep: str = '.',
+                    max_level: int = 1):
+    """
+    Builds a DataFrame of selected flattened columns from a list of nested
+    records, as pd.json_normalize(records, sep=sep, max_level=max_level)
+    [columns] does, without flattening the rest of each record.
+
+    Parameters
+    ----------
+    records: list
+        List of dicts, e.g. Members from the members query
+    columns: list
+        Flattened column names to keep, in output order. Each is looked up
+        directly by its key path, so the rest of the record is never walked.
+        A KeyError is raised for any column found in no record.
+    sep: str
+        Separator between nested key names.
+        The default is '.'
+    max_level: int
+        Number of nested levels to flatten.
+        The default is 1
+
+    Returns
+    -------
+    flat_data: pd.DataFrame
+        One row per record, one column per requested key.
+    """
+
+    # paths nested below max_level are never flattened, so cannot be found
+    paths = [tuple(column.split(sep)) for column in columns]
+    values = {}
+    for column, path in zip(columns, paths):
+        if len(path) <= max_level + 1:
+            values[column] = [_resolve(record, path, max_level)
+                              for record in records]
+
+    # match expanded_table[mp_cols], failing loudly on unknown columns
+    missing = [column for column in columns
+               if column not in values
+               or all(v is _MISSING for v in values[column])]
+    if missing:
+        raise KeyError('{0} not found in records'.format(missing))
+
+    flat_data = pd.DataFrame(
+        {column: [float('nan') if v is _MISSING else v for v in column_values]
+         for column, column_values in values.items()},
+        columns=columns)
+
+    return flat_data
+
+
 def raise_request(url, headers):
 
-    r = requests.get(url, headers)
+    r = _SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
 
     if r.status_code != 200:
-        logging.warning('Error code {0} from {1}'.format(r.status_code, url))
+        logging.warning('Error code %s from %s', r.status_code, url)
         r = None
 
     return r
@@ -70,38 +178,20 @@ def main(config: configparser.ConfigParser):
 
     logging.info('Starting main process')
     url = config['PARSER']['members_url']
-    # response = requests.get("http://data.parliament.uk/membersdataplatform/services/mnis/members/query/House=Commons%7CIsEligible=true/")
-    r = requests.get(url, headers=cfg_get_dict(config, 'PARSER','headers'))
-    logging.info('request with status: {0}'.format(r.status_code))
-    # print(type(response))
-    # print(response.content)
-
-    # root = ET.fromstring(response.text)
-    # tree = ET.ElementTree(root)
-    # #tree.write('raw_output.xml')
-
-    # mp_data = pd.read_xml(response.content, parser='etree')
-
-    # core_mp_data = mp_data[]
+    r = raise_request(url, cfg_get_dict(config, 'PARSER', 'headers'))
+    if r is None:
+        return
+    logging.info('request with status: %s', r.status_code)
 
-    # print(type(config['PARSER']['test']))
     mp_cols = cfg_get_list(config, 'PARSER', 'mp_cols')
-    # mp_cols = config['PARSER']['mp_cols'].split(',\n')
-    # 'http://data.parliament.uk/membersdataplatform/services/mnis/members' \
-    # '/query/membership=all|commonsmemberbetween=2015-03-01and2022-02-17/'
-    # core_mp_data = mp_data[mp_cols]
-    # return response
 
-    test_url = 'http://data.parliament.uk/membersdataplatform/services/mnis/HouseOverview/Commons/2012-01-01'
+    # only pretty-print the dump when debugging
+    indent = 2 if logging.getLogger().isEnabledFor(logging.DEBUG) else None
+    data = write_to_json(r, 'mps.json', indent=indent)
 
-    r.encoding = 'utf-8-sig'
-    data = r.json()
-    with open('mps.json', 'w') as f:
-        json.dump(data, f, indent=2)
-
-    expanded_table = pd.json_normalize(data['Members']['Member'], max_level=1)
-    logging.debug(expanded_table.shape)
-    core_mp_data = expanded_table[mp_cols]
+    core_mp_data = flatten_records(data['Members']['Member'],
+                                   mp_cols,
+                                   max_level=1)
     logging.debug(core_mp_data.columns)
     logging.debug(core_mp_data.shape)
 
@@ -114,7 +204,8 @@ def main(config: configparser.ConfigParser):
 def write_to_json(r: requests.Response,
                   file_name: str,
                   encoding: str = 'utf-8-sig',
-                  write_mode: str = 'w'):
+                  write_mode: str = 'w',
+                  indent: int = None):
     """
     Takes Response, encodes, pulls out data as json and writes to file
     Parameters
@@ -129,77 +220,250 @@ def write_to_json(r: requests.Response,
     write_mode: str
         Opens file_name in specific mode.
         The default is 'w'
+    indent: int
+        Indent level to pretty-print with, None for compact output.
+        The default is None
+
+    Returns
+    -------
+    data: dict
+        Parsed json content of the response
     """
 
-    logging.info('Dumping to {0}'.format(file_name))
+    logging.info('Dumping to %s', file_name)
     r.encoding = encoding
     data = r.json()
     with open(file_name, write_mode) as f:
-        json.dump(data, f, indent=2)
+        json.dump(data, f, indent=indent)
 
     exist_status = os.path.exists(file_name)
 
     if exist_status:
         time = dt.datetime.utcfromtimestamp(os.path.getmtime(file_name))
         logging.debug('Dump complete. Status unknown: File exists, '
-                      'last modified: {0}.'.format(time))
+                      'last modified: %s.', time)
     else:
         logging.warning('Dump failed. Status unknown - File does not exist.')
 
-def get_head_shots(config, data):
+    return data
 
-    logging.info('Beginning headshot api scrape.')
 
-    base_image_url = config['PARSER']['image_base_url']
-    hex_dict = cfg_get_dict(config, 'PARSER', 'image_bytes')
+def get_head_shot_type(image_config: str,
+                       byte_dict: dict,
+                       content_type: str,
+                       first_bytes: bytes):
+    """
+    Determines the file type to save a headshot as. Uses the configured
+    headshot_type, or when set to GET compares the Content-Type header
+    against the leading byte of the image, preferring the latter.
+
+    Parameters
+    ----------
+    image_config: str
+        headshot_type value from config. GET to detect from the response.
+    byte_dict: dict
+        Mapping of leading byte (as int) to file type.
+    content_type: str
+        Content-Type header of the image response.
+    first_bytes: bytes
+        Leading bytes of the image content.
+
+    Returns
+    -------
+    headshot_type: str
+        File extension to save the headshot with.
+    """
+
+    if image_config != 'GET':
+        return image_config
+
+    headshot_header_type = content_type.split('/')[-1]
+    logging.debug('Header suggests %s filetype', headshot_header_type)
+
+    headshot_hex = byte_dict.get(first_bytes[0]) if first_bytes else None
 
-    for index, row in data.iterrows():
-        id = row['@Member_Id']
+    if headshot_hex is not None:
+        logging.debug('Bytes suggests %s filetype', headshot_hex)
 
-        name = row['ListAs']
-        logging.debug('Storing image for {0}_{1}'.format(name, id))
-        clean_name = name.replace(' ', '_').replace(',', '')
+        if headshot_hex != headshot_header_type:
+            logging.warning('Mismatched type. Defaulting to bytes value')
+        headshot_type = headshot_hex
+    else:
+        headshot_type = headshot_header_type
+
+    return headshot_type
+
+
+def save_head_shot(member_url: str,
+                   file_stem: str,
+                   image_config: str,
+                   byte_dict: dict,
+                   modified_since: float = None):
+    """
+    Requests a single headshot and streams it to disk in chunks. The first
+    chunk's leading byte is used for type detection, and the body is written
+    to a temporary file that replaces the image once complete. Run from worker
+    threads so that many downloads can wait on the network at once.
+
+    Parameters
+    ----------
+    member_url: str
+        Image url for a member
+    file_stem: str
+        Path to write the image to, excluding the file extension.
+    image_config: str
+        headshot_type value from config.
+    byte_dict: dict
+        Mapping of leading byte (as int) to file type.
+    modified_since: float
+        Modification time of an existing copy of the image. When given, the
+        request is made conditional and a 304 leaves the file untouched.
+        The default is None
+
+    Returns
+    -------
+    status_code: int
+        HTTP status code of the response. On a 200 the new image replaces any
+        existing copy, including one saved under a different extension.
+    """
 
-        member_url = base_image_url + id
+    headers = IMAGE_HEADERS
+    if modified_since is not None:
+        headers = dict(IMAGE_HEADERS)
+        headers['If-Modified-Since'] = formatdate(modified_since,
+                                                  usegmt=True)
 
-        r = requests.get(member_url)
+    with _SESSION.get(member_url,
+                      headers=headers,
+                      stream=True,
+                      timeout=REQUEST_TIMEOUT) as r:
         if r.status_code == 200:
-            image_config = config['PARSER']['headshot_type']
-
-            # use image_config value or get from headers
-            if image_config == 'GET':
-                headshot_header_type = r.headers['Content-Type'].split('/')[-1]
-                logging.debug('Header suggests {0} filetype'.format(
-                    headshot_header_type))
-
-                initial_hex = r.content.hex()[:2]
-
-                if initial_hex in hex_dict.keys():
-                    headshot_hex = hex_dict[initial_hex]
-                    logging.debug('Bytes suggests {0} filetype'.format(
-                        headshot_hex))
-
-                    if headshot_hex != headshot_header_type:
-                        logging.warning('Mismatched type. Defaulting to '
-                                        'bytes value')
-                    headshot_type = headshot_hex
-                else:
-                    headshot_type = headshot_header_type
-
-            else:
-                headshot_type = image_config
-
-            image_location = "../headshots/{0}_{1}.{2}".format(clean_name,
-                                                               id,
-                                                               headshot_type)
-
-            with open(image_location, 'wb') as f:
-                logging.debug('Writing to {0}'.format(image_location))
-                f.write(r.content)
-
-        else:
-            logging.warning('Received status code {0} for {1}. File not '
-                            'downloaded'.format(r.status_code, clean_name))
+            chunks = r.iter_content(chunk_size=65536)
+            first_chunk = next(chunks, b'')
+            first_bytes = first_chunk[:1]
+
+            headshot_type = get_head_shot_type(image_config,
+                                               byte_dict,
+                                               r.headers.get('Content-Type',
+                                                             ''),
+                                               first_bytes)
+
+            image_location = '{0}.{1}'.format(file_stem, headshot_type)
+
+            # stream into a temp file so a failed download never leaves a
+            # truncated image, or replaces a good one
+            # hidden so it is never taken for an existing headshot
+            temp_location = os.path.join(
+                os.path.dirname(file_stem),
+                '.' + os.path.basename(file_stem) + '.part')
+            try:
+                with open(temp_location, 'wb') as f:
+                    logging.debug('Writing to %s', image_location)
+                    f.write(first_chunk)
+                    for chunk in chunks:
+                        f.write(chunk)
+                os.replace(temp_location, image_location)
+            except BaseException:
+                if os.path.exists(temp_location):
+                    os.remove(temp_location)
+                raise
+
+            # drop copies of this headshot saved under another extension
+            stem_name = os.path.basename(file_stem)
+            for old_location in glob.glob(glob.escape(file_stem) + '.*'):
+                if (old_location != image_location and
+                        os.path.basename(old_location).rsplit('.', 1)[0]
+                        == stem_name):
+                    os.remove(old_location)
+
+    return r.status_code
+
+
+_NAME_TRANSLATION = str.maketrans({' ': '_', ',': None})
+
+
+def get_head_shots(config, data):
+
+    logging.info('Beginning headshot api scrape.')
+
+    base_image_url = config['PARSER']['image_base_url']
+    hex_dict = cfg_get_dict(config, 'PARSER', 'image_bytes')
+    byte_dict = {int(k, 16): v for k, v in hex_dict.items()}
+    image_config = config['PARSER']['headshot_type']
+    max_workers = config.getint('PARSER', 'headshot_workers',
+                                fallback=POOL_MAXSIZE)
+    if max_workers > POOL_MAXSIZE:
+        # more workers than pooled connections just churns connections
+        logging.warning('headshot_workers %s exceeds connection pool size. '
+                        'Using %s', max_workers, POOL_MAXSIZE)
+        max_workers = POOL_MAXSIZE
+    force_refresh = config.getboolean('PARSER', 'force_refresh',
+                                      fallback=False)
+    revalidate = config.getboolean('PARSER', 'revalidate', fallback=False)
+
+    headshot_dir = '../headshots/'
+    os.makedirs(headshot_dir, exist_ok=True)
+    with os.scandir(headshot_dir) as entries:
+        existing = {e.name.rsplit('.', 1)[0]: e.stat().st_mtime
+                    for e in entries}
+
+    # file names and urls are built column-wise up front
+    member_ids = data['@Member_Id'].astype(str)
+    clean_names = data['ListAs'].str.translate(_NAME_TRANSLATION)
+    file_keys = (clean_names + '_' + member_ids).to_numpy()
+    urls = (base_image_url + member_ids).to_numpy()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloads = {}
+        try:
+            skipped = 0
+            for file_key, member_url in zip(file_keys, urls):
+                modified_since = existing.get(file_key)
+                if modified_since is not None and not (force_refresh or
+                                                       revalidate):
+                    logging.debug('Image exists for %s. Skipping', file_key)
+                    skipped += 1
+                    continue
+
+                # force_refresh always downloads, revalidate asks the
+                # server first
+                if force_refresh:
+                    modified_since = None
+
+                logging.debug('Storing image for %s', file_key)
+                future = executor.submit(save_head_shot,
+                                         member_url,
+                                         headshot_dir + file_key,
+                                         image_config,
+                                         byte_dict,
+                                         modified_since)
+                downloads[future] = file_key
+
+            status_counts = {}
+            for future, file_key in downloads.items():
+                try:
+                    status_code = future.result()
+                except requests.RequestException as e:
+                    logging.warning('Request failed for %s: %s. File not '
+                                    'downloaded', file_key, e)
+                    status_code = None
+
+                status_counts[status_code] = status_counts.get(status_code,
+                                                               0) + 1
+                if status_code not in (200, 304, None):
+                    logging.warning('Received status code %s for %s. File '
+                                    'not downloaded', status_code, file_key)
+        except BaseException:
+            # cancel queued downloads rather than letting the executor run
+            # them all before the error surfaces
+            for future in downloads:
+                future.cancel()
+            raise
+
+    logging.info('Headshots downloaded: %s, unchanged: %s, skipped: %s, '
+                 'failed: %s', status_counts.pop(200, 0),
+                 status_counts.pop(304, 0), skipped,
+                 sum(status_counts.values()))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from main import flatten_records
+
+NIL = {'@xsi:nil': 'true',
+       '@xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
+
+RECORDS = [{'@Member_Id': '1',
+            'DisplayAs': 'A',
+            'LayingMinisterName': NIL,
+            'Party': {'@Id': '4', '#text': 'Lab'},
+            'HouseStartDate': '2010-05-06'},
+           {'@Member_Id': '2',
+            'DisplayAs': 'B',
+            'LayingMinisterName': 'Minister B',
+            'Party': {'@Id': '5', '#text': NIL},
+            'HouseStartDate': '2015-05-07',
+            'Extra': 3}]
+
+
+def test_matches_json_normalize():
+    expected = pd.json_normalize(RECORDS, max_level=1)
+    cols = list(expected.columns)
+
+    result = flatten_records(RECORDS, cols, max_level=1)
+
+    assert result.equals(expected)
+
+
+def test_columns_match_json_normalize_with_nil_dict():
+    cols = ['Party.#text', '@Member_Id', 'LayingMinisterName',
+            'HouseStartDate', 'Extra']
+    expected = pd.json_normalize(RECORDS, max_level=1).reindex(columns=cols)
+
+    result = flatten_records(RECORDS, cols, max_level=1)
+
+    assert result.equals(expected)
+    assert pd.isna(result.loc[0, 'LayingMinisterName'])
+
+
+def test_unknown_column_raises():
+    with pytest.raises(KeyError):
+        flatten_records(RECORDS, ['@Member_Id', 'Typo'], max_level=1)
+
+
+def test_column_below_max_level_raises():
+    with pytest.raises(KeyError):
+        flatten_records(RECORDS, ['Party.#text'], max_level=0)
@@ -0,0 +1,196 @@
+import configparser
+import logging
+import os
+import sys
+
+import pandas as pd
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import main
+
+JPEG = b'\xff\xd8' + b'j' * 100
+PNG = b'\x89PNG' + b'p' * 100
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, content=b'', content_type='image/jpeg',
+                 fail_after_first_chunk=False):
+        self.status_code = status_code
+        self.headers = {'Content-Type': content_type}
+        self.content = content
+        self.fail_after_first_chunk = fail_after_first_chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def iter_content(self, chunk_size=1):
+        yield self.content[:chunk_size]
+        if self.fail_after_first_chunk:
+            raise requests.exceptions.ChunkedEncodingError('Connection broken')
+        for i in range(chunk_size, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+@pytest.fixture
+def headshot_dir(tmp_path, monkeypatch):
+    # get_head_shots writes to ../headshots/ relative to the working dir
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    monkeypatch.chdir(work_dir)
+
+    return tmp_path / 'headshots'
+
+
+class RequestLog(list):
+    """(url, headers) of each request made, plus responses to give by url;
+    any other url gets a 200 jpeg."""
+
+    def __init__(self):
+        super().__init__()
+        self.responses = {}
+
+
+@pytest.fixture
+def requests_made(monkeypatch):
+    made = RequestLog()
+    responses = made.responses
+
+    def fake_get(url, headers=None, **kwargs):
+        made.append((url, dict(headers or {})))
+        return responses.get(url, FakeResponse(200, JPEG))
+
+    monkeypatch.setattr(main._SESSION, 'get', fake_get)
+
+    return made
+
+
+def make_config(force_refresh=False, revalidate=False):
+    config = configparser.ConfigParser(delimiters=("="))
+    config['PARSER'] = {'image_base_url': 'http://images/',
+                        'image_bytes': '89: png,\nff: jpeg',
+                        'headshot_type': 'GET',
+                        'headshot_workers': '4',
+                        'force_refresh': str(force_refresh),
+                        'revalidate': str(revalidate)}
+
+    return config
+
+
+MEMBERS = pd.DataFrame({'@Member_Id': ['1', '2'],
+                        'ListAs': ['Smith, John', 'Jones, Ann']})
+
+
+def summary(caplog):
+    return [r.getMessage() for r in caplog.records
+            if r.getMessage().startswith('Headshots downloaded')][-1]
+
+
+def test_downloads_new_headshots(headshot_dir, requests_made, caplog):
+    caplog.set_level(logging.INFO)
+
+    main.get_head_shots(make_config(), MEMBERS)
+
+    assert sorted(os.listdir(headshot_dir)) == ['Jones_Ann_2.jpeg',
+                                                'Smith_John_1.jpeg']
+    assert (headshot_dir / 'Smith_John_1.jpeg').read_bytes() == JPEG
+    mode = os.stat(headshot_dir / 'Smith_John_1.jpeg').st_mode & 0o777
+    umask = os.umask(0)
+    os.umask(umask)
+    assert mode == 0o666 & ~umask
+    assert summary(caplog) == ('Headshots downloaded: 2, unchanged: 0, '
+                               'skipped: 0, failed: 0')
+
+
+def test_skips_existing_headshots(headshot_dir, requests_made, caplog):
+    caplog.set_level(logging.INFO)
+    headshot_dir.mkdir()
+    (headshot_dir / 'Smith_John_1.jpeg').write_bytes(b'old')
+
+    main.get_head_shots(make_config(), MEMBERS)
+
+    assert [url for url, _ in requests_made] == ['http://images/2']
+    assert (headshot_dir / 'Smith_John_1.jpeg').read_bytes() == b'old'
+    assert summary(caplog) == ('Headshots downloaded: 1, unchanged: 0, '
+                               'skipped: 1, failed: 0')
+
+
+def test_revalidate_sends_if_modified_since(headshot_dir, requests_made,
+                                            caplog):
+    caplog.set_level(logging.INFO)
+    headshot_dir.mkdir()
+    (headshot_dir / 'Smith_John_1.jpeg').write_bytes(b'old')
+    requests_made.responses['http://images/1'] = FakeResponse(304)
+
+    main.get_head_shots(make_config(revalidate=True), MEMBERS)
+
+    headers = dict(requests_made)
+    assert 'If-Modified-Since' in headers['http://images/1']
+    assert 'If-Modified-Since' not in headers['http://images/2']
+    assert (headshot_dir / 'Smith_John_1.jpeg').read_bytes() == b'old'
+    assert summary(caplog) == ('Headshots downloaded: 1, unchanged: 1, '
+                               'skipped: 0, failed: 0')
+
+
+def test_force_refresh_downloads_unconditionally(headshot_dir, requests_made,
+                                                 caplog):
+    caplog.set_level(logging.INFO)
+    headshot_dir.mkdir()
+    (headshot_dir / 'Smith_John_1.jpeg').write_bytes(b'old')
+
+    main.get_head_shots(make_config(force_refresh=True), MEMBERS)
+
+    assert all('If-Modified-Since' not in headers
+               for _, headers in requests_made)
+    assert (headshot_dir / 'Smith_John_1.jpeg').read_bytes() == JPEG
+    assert summary(caplog) == ('Headshots downloaded: 2, unchanged: 0, '
+                               'skipped: 0, failed: 0')
+
+
+def test_download_replaces_other_extension(headshot_dir, requests_made):
+    headshot_dir.mkdir()
+    (headshot_dir / 'Smith_John_1.jpeg').write_bytes(b'old')
+    (headshot_dir / 'Smith_John_12.jpeg').write_bytes(b'other member')
+    requests_made.responses['http://images/1'] = FakeResponse(
+        200, PNG, content_type='image/png')
+
+    main.get_head_shots(make_config(force_refresh=True), MEMBERS)
+
+    assert sorted(os.listdir(headshot_dir)) == ['Jones_Ann_2.jpeg',
+                                                'Smith_John_1.png',
+                                                'Smith_John_12.jpeg']
+    assert (headshot_dir / 'Smith_John_1.png').read_bytes() == PNG
+
+
+def test_failed_stream_keeps_existing_headshot(headshot_dir, requests_made,
+                                               caplog):
+    caplog.set_level(logging.INFO)
+    headshot_dir.mkdir()
+    (headshot_dir / 'Smith_John_1.jpeg').write_bytes(b'old')
+    requests_made.responses['http://images/1'] = FakeResponse(
+        200, JPEG * 1000, fail_after_first_chunk=True)
+
+    main.get_head_shots(make_config(force_refresh=True), MEMBERS)
+
+    assert sorted(os.listdir(headshot_dir)) == ['Jones_Ann_2.jpeg',
+                                                'Smith_John_1.jpeg']
+    assert (headshot_dir / 'Smith_John_1.jpeg').read_bytes() == b'old'
+    assert summary(caplog) == ('Headshots downloaded: 1, unchanged: 0, '
+                               'skipped: 0, failed: 1')
+
+
+def test_error_status_counts_as_failed(headshot_dir, requests_made, caplog):
+    caplog.set_level(logging.INFO)
+    requests_made.responses['http://images/2'] = FakeResponse(404)
+
+    main.get_head_shots(make_config(), MEMBERS)
+
+    assert os.listdir(headshot_dir) == ['Smith_John_1.jpeg']
+    assert summary(caplog) == ('Headshots downloaded: 1, unchanged: 0, '
+                               'skipped: 0, failed: 1')